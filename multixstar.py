@@ -15,69 +15,210 @@ import argparse
 import logging
 import multiprocessing as mp
 import os
+import random
 import subprocess
 import sys
-from distutils.dir_util import copy_tree
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 from pathlib import Path
 from shutil import copy as copy_file
+from shutil import copyfile
+from shutil import move as move_file
 import re
+import shlex
 from datetime import datetime
+from functools import lru_cache
+from logging.handlers import MemoryHandler, QueueHandler, QueueListener
 from time import sleep
 
 __version__ = "0.2.1"
 
+# rough upper bound on the size of one xstar run dir, used to decide if staging fits
+STAGING_BYTES_PER_JOB = 64 * 1024 ** 2
 
-def run(cmd, env=None, shell=None, return_stdout=True, **extra_config):
-    """ runs cmds in csh"""
+# environment xstar runs in, set per worker by pool_init
+WORKER_ENV = os.environ
+
+# thread pools xstar's numerical libraries may start on top of our one process per core
+BLAS_THREAD_VARS = (
+    "OMP_NUM_THREADS",
+    "OPENBLAS_NUM_THREADS",
+    "MKL_NUM_THREADS",
+    "VECLIB_MAXIMUM_THREADS",
+    "NUMEXPR_NUM_THREADS",
+)
+
+
+def run(cmd, env=None, return_stdout=True, cwd=None, **extra_config):
+    """ runs a cmd given as an argv list, without going through a shell"""
     config = {
-        "shell": True,
-        "executable": shell or os.getenv("SHELL"),
         "stdout": subprocess.PIPE,
     }
     if env:
         config["env"] = env
+    if cwd:
+        config["cwd"] = cwd
 
     if extra_config:
         config.update(extra_config)
-    proc = subprocess.Popen(cmd, **config)
+    proc = subprocess.Popen(list(map(str, cmd)), **config)
     if return_stdout:
         return proc.communicate()[0]
     return proc
 
 
-def setup_pfiles():
-    dst = Path("pfiles")
-    dst.mkdir()
-    src = Path(os.getenv("HEADAS")).joinpath("syspfiles/xstar.par")
-    copy_file(src, dst)
-    os.environ["PFILES"] = str(dst)
+def get_shared_pfiles(root):
+    return root.joinpath("_pfiles")
+
+
+def setup_shared_pfiles(root):
+    """One copy of the xstar.par template shared by all the jobs under root"""
+    dst = get_shared_pfiles(root)
+    dst.mkdir(exist_ok=True)
+    # a real copy, so nothing done to the run's output can reach the HEASoft install
+    copy_file(get_xstar_par(), dst)
     return dst
 
 
+def setup_pfiles(dir):
+    """PFILES for a job: xstar writes to its own dir and reads defaults from the shared one"""
+    dst = dir.joinpath("pfiles")
+    # also makes the job dir itself, so the workers create their dirs in parallel
+    dst.mkdir(parents=True, exist_ok=True)
+    return "{};{}".format(dst, get_shared_pfiles(dir.parent))
+
+
+@lru_cache(maxsize=1)
 def get_executeable_dir():
     return Path(os.getenv("FTOOLS")).joinpath("bin")
 
 
-def get_xstar_output(xstar):
-    return map(lambda l: "XSTAR OUTPUT: {}".format(l.decode("utf-8")), xstar.stdout.readlines(),)
+@lru_cache(maxsize=1)
+def get_xstar_par():
+    return Path(os.getenv("HEADAS")).joinpath("syspfiles/xstar.par")
+
+
+def read_cpu_list(path):
+    """Parses a sysfs cpu list such as 0-3,8-11"""
+    cpus = set()
+    try:
+        text = path.read_text().strip()
+    except OSError:
+        return cpus
+    for part in filter(None, text.split(",")):
+        start, _, end = part.partition("-")
+        cpus.update(range(int(start), int(end or start) + 1))
+    return cpus
+
+
+def get_cpu_node(cpu):
+    nodes = Path("/sys/devices/system/cpu/cpu{}".format(cpu)).glob("node*")
+    return min((int(node.name[4:]) for node in nodes), default=0)
+
+
+def get_worker_cores():
+    """Cpus we may run on: one per physical core grouped by NUMA node, then their HT siblings"""
+    if not hasattr(os, "sched_getaffinity"):
+        return []
+    cores = []
+    hyperthreads = []
+    seen = set()
+    for cpu in sorted(os.sched_getaffinity(0), key=lambda c: (get_cpu_node(c), c)):
+        siblings = read_cpu_list(
+            Path("/sys/devices/system/cpu/cpu{}/topology/thread_siblings_list".format(cpu))
+        )
+        if seen & siblings:
+            hyperthreads.append(cpu)
+            continue
+        seen.update(siblings or {cpu})
+        cores.append(cpu)
+    return cores + hyperthreads
+
+
+def set_worker_env(env):
+    global WORKER_ENV
+    WORKER_ENV = env
+
+
+def pool_init(core_slots, log_queue, env):
+    """Sends worker logging to the parent and pins each worker (and so its xstar) to its own core"""
+    set_worker_env(env)
+    root = logging.getLogger()
+    for handler in root.handlers:
+        # copies of the parent's handlers under fork, flushed by the parent before forking
+        handler.close()
+    root.handlers = [QueueHandler(log_queue)]
+    root.setLevel(logging.INFO)
+    if core_slots is None:
+        return
+    next_slot, cores = core_slots
+    with next_slot.get_lock():
+        slot = next_slot.value
+        next_slot.value += 1
+    if slot >= len(cores):
+        logging.warning("Worker {} not pinned: no core left for it".format(os.getpid()))
+        return
+    try:
+        os.sched_setaffinity(0, {cores[slot]})
+    except OSError as err:
+        logging.warning("Worker {} not pinned to core {}: {}".format(os.getpid(), cores[slot], err))
+
+
+def get_mp_context():
+    """fork on Linux, the workers need nothing from a fresh interpreter; elsewhere the default"""
+    if sys.platform.startswith("linux"):
+        return mp.get_context("fork")
+    return mp.get_context()
+
+
+def make_core_slots(nproc, ctx):
+    """Shared counter and cores for pool_init, None when cpu affinity is not supported"""
+    cores = get_worker_cores()[:nproc]
+    if not cores:
+        return None
+    return ctx.Value("i", 0), ctx.Array("i", cores, lock=False)
 
 
 def run_xstar(args):
     dir, cmd = args
-    result = []
-    previous_dir = os.getcwd()
-    os.chdir(dir)
-    result.append("Running: {}".format(cmd))
-    pfiles_dir = setup_pfiles()
-    result.append("Copied pfiles to local folder: {}".format(pfiles_dir))
+    dir = Path(dir)
+    logging.info("Running: {}".format(cmd))
+    pfiles = setup_pfiles(dir)
+    logging.info("PFILES: {}".format(pfiles))
+    env = dict(WORKER_ENV)
+    env["PFILES"] = pfiles
+    exe, *xstar_args = shlex.split(cmd)
     xstar = run(
-        "{exe_dir}/{cmd}".format(exe_dir=get_executeable_dir(), cmd=cmd), return_stdout=False
+        [get_executeable_dir().joinpath(exe), *xstar_args],
+        env,
+        return_stdout=False,
+        cwd=dir,
+        bufsize=1,
+        universal_newlines=True,
+        # a stray non utf-8 byte in the output should not take the job down with it
+        errors="replace",
     )
-    result.append("Process ID: {}".format(xstar.pid))
-    xstar.wait()
-    result.extend(get_xstar_output(xstar))
-    os.chdir(previous_dir)
-    return "\n".join(result)
+    logging.info("Process ID: {}".format(xstar.pid))
+    # drain the pipe as we go so xstar never blocks on a full buffer
+    for line in iter(xstar.stdout.readline, ""):
+        logging.info("XSTAR OUTPUT ({}): {}".format(dir, line.rstrip()))
+    xstar.stdout.close()
+    returncode = xstar.wait()
+    logging.info("Finished {} with exit code {}".format(dir, returncode))
+    return returncode == 0
+
+
+def run_xstar_chunk(chunk):
+    """Runs several jobs in one worker, returns the names of those that failed"""
+    failed = []
+    for job in chunk:
+        try:
+            ok = run_xstar(job)
+        except Exception as err:
+            logging.error("Job {} raised: {}".format(job[0], err))
+            ok = False
+        if not ok:
+            failed.append(job[0])
+    return failed
 
 
 def get_new_dir(dir, num, extra):
@@ -86,15 +227,52 @@ def get_new_dir(dir, num, extra):
 
 def make_new_dir(dir, extra=None):
     """ generates a unqie suffix"""
-    i = 0
-    new_dir = get_new_dir(dir, i, extra)
-    while new_dir.exists():
-        i += 1
-        new_dir = get_new_dir(dir, i, extra)
+    pattern = re.compile(re.escape(get_new_dir(dir, "", extra).name) + r"(\d+)$")
+    last = -1
+    with os.scandir(str(dir)) as entries:
+        for entry in entries:
+            match = pattern.match(entry.name)
+            if match:
+                last = max(last, int(match.group(1)))
+    new_dir = get_new_dir(dir, last + 1, extra)
     new_dir.mkdir()
     return new_dir
 
 
+def default_staging_dir():
+    return Path(os.environ.get("XDG_RUNTIME_DIR", "/dev/shm"))
+
+
+def make_staging_dir(base, njobs):
+    """Makes a dir under base to run the jobs in, None if base is unusable or too small"""
+    try:
+        stat = os.statvfs(str(base))
+    except OSError:
+        return None
+    if stat.f_bavail * stat.f_frsize < njobs * STAGING_BYTES_PER_JOB:
+        return None
+    staging_dir = base.joinpath("multixstar.{}".format(os.getpid()))
+    try:
+        staging_dir.mkdir()
+    except OSError:
+        return None
+    return staging_dir
+
+
+def unstage_run_dirs(staging_dir, model_dir):
+    """Moves finished run dirs back into the model dir"""
+    for run_dir in staging_dir.iterdir():
+        move_file(str(run_dir), str(model_dir.joinpath(run_dir.name)))
+    staging_dir.rmdir()
+
+
+def positive_int(value):
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError("{} is not a positive integer".format(value))
+    return number
+
+
 def process_flags(argv=None):
     """
     processing script arguments
@@ -142,12 +320,43 @@ spectra be collated into a single table model with xstar2table
     parser.add_argument(
         "-n",
         "--nproc",
-        type=int,
+        type=positive_int,
         dest="nproc",
         default=mp.cpu_count(),
         metavar="NUMPROC",
         help="Max number of processors per host",
     )
+    parser.add_argument(
+        "--chunksize",
+        type=positive_int,
+        dest="chunksize",
+        default=None,
+        metavar="CHUNKSIZE",
+        help="Jobs handed to a worker at a time (default jobs / (4 * NUMPROC))",
+    )
+    parser.add_argument(
+        "--blas-threads",
+        type=positive_int,
+        dest="blas_threads",
+        default=1,
+        metavar="NUMTHREADS",
+        help="Threads each xstar may use for OpenMP/BLAS (default 1)",
+    )
+    parser.add_argument(
+        "--stage",
+        action="store_true",
+        dest="stage",
+        default=False,
+        help="Run jobs in a RAM backed staging dir and move the results to the work dir at the end",
+    )
+    parser.add_argument(
+        "--staging-dir",
+        dest="staging_dir",
+        default=default_staging_dir(),
+        type=lambda x: Path(x).absolute(),
+        metavar="STAGINGDIR",
+        help="Staging dir used with --stage (default $XDG_RUNTIME_DIR or /dev/shm)",
+    )
     # options stores known arguments and
     # args stores potential xstinitable arguments
     options, args = parser.parse_known_args()
@@ -160,144 +369,249 @@ def check_enviroment(dir):
     if "FTOOLS" not in os.environ:
         raise OSError("$FTOOLS not set!\n please run heainit and rerun")
 
+    if "HEADAS" not in os.environ:
+        raise OSError("$HEADAS not set!\n please run heainit and rerun")
+
     if not dir.is_dir():
         raise IOError("{} is not a dir".format(dir))
 
-    testfile = dir.joinpath("write_check.test")
-    testfile.touch()
-    testfile.unlink()
+    if not os.access(str(dir), os.W_OK):
+        raise IOError("{} is not writable".format(dir))
 
 
-def get_xstar_cmds(args=None, binpath=None):
-    print("Making XSTAR commands")
+def get_xstar_cmds(workdir, args=None, binpath=None):
+    logging.info("Making XSTAR commands")
     joblist = None
     if args and len(args) > 0:
         joblist = Path(args[0])
-        joblist_local = Path(joblist.name)
-
-        if joblist.exists():
-            print("Joblist {} found".format(joblist))
-            copy_file(joblist, joblist_local)
-            copy_file(joblist.with_suffix(".fits"), joblist_local.with_suffix(".fits"))
-            joblist = joblist_local
-        elif Path("..").joinpath(joblist).exists():
-            joblist = Path("..").joinpath(joblist)
-            print("Joblist {} found".format(joblist))
-            copy_file(joblist, joblist_local)
-            copy_file(joblist.with_suffix(".fits"), joblist_local.with_suffix(".fits"))
+        joblist_local = workdir.joinpath(joblist.name)
+
+        for found in (joblist, workdir.parent.joinpath(joblist)):
+            if found.exists():
+                logging.info("Joblist {} found".format(found))
+                # the joblist and its fits table travel together
+                for src in (found, found.with_suffix(".fits")):
+                    copy_file(src, workdir.joinpath(src.name))
+                break
         joblist = joblist_local
     else:
         args = []
 
     if not joblist:
-        print("No joblist found: runing xstinitable to make joblist")
-        run(
-            "{exe} {args}".format(
-                exe=binpath.joinpath("xstinitable"), args=" ".join(map(str, args))
-            ),
-            os.environ,
-            stdout=None,
-        )
-        joblist = Path("xstinitable.lis")
-    return joblist.read_text().splitlines()
+        logging.info("No joblist found: runing xstinitable to make joblist")
+        run([binpath.joinpath("xstinitable"), *args], cwd=workdir, stdout=None)
+        joblist = workdir.joinpath("xstinitable.lis")
+    return iter_lines(joblist)
+
+
+def iter_lines(path):
+    """Yields the non blank lines of path without loading the whole file"""
+    with path.open() as f:
+        for line in f:
+            line = line.rstrip("\n")
+            if line.strip():
+                yield line
 
 
 def make_jobs(cmds):
-    print("generating jobs from commands")
+    logging.info("generating jobs from commands")
+    # the padding width needs the job count so the commands are collected once here
+    cmds = list(cmds)
     padding = "".join(["%0", str(len(str(len(cmds)))), "d"])
-    return {padding % n: x for n, x in enumerate(cmds, start=1)}
+    return [(padding % n, x) for n, x in enumerate(cmds, start=1)]
+
+
+def has_spectrum(dir):
+    return dir.joinpath("xout_spect1.fits").exists()
 
 
 def check_results(result_dirs):
-    fault = []
-    for dir in result_dirs:
-        if not dir.joinpath("xout_spect1.fits").exists():
-            fault.append(dir)
-    return fault
+    # the stats are pure latency on network filesystems so overlap them in threads
+    with ThreadPoolExecutor(max_workers=16) as executor:
+        found = executor.map(has_spectrum, result_dirs)
+        return [dir for dir, ok in zip(result_dirs, found) if not ok]
 
 
 def get_model_name(jobs):
     """Get a job and find the model name"""
-    return re.search("modelname='(.*?)'", next(iter(jobs.values()))).group(1)
+    cmd = jobs[0][1]
+    for token in shlex.split(cmd):
+        if token.startswith("modelname="):
+            return token.split("=", 1)[1]
+    raise ValueError("No modelname in {}".format(cmd))
+
+
+class BatchFileHandler(logging.FileHandler):
+    """FileHandler that leaves flushing to the BatchMemoryHandler in front of it"""
+
+    def _open(self):
+        return open(self.baseFilename, self.mode, buffering=1 << 16, encoding=self.encoding)
+
+    def flush(self):
+        pass
+
+    def flush_batch(self):
+        super().flush()
+
+
+class BatchMemoryHandler(MemoryHandler):
+    """MemoryHandler that flushes its target's stream once per batch rather than per record"""
 
+    def flush(self):
+        super().flush()
+        if self.target:
+            self.target.flush_batch()
 
-def make_run_dirs(run_dirs):
-    print("Making run dirs:", list(str(d) for d in run_dirs))
-    for dir in run_dirs:
-        dir.mkdir()
+    def close(self):
+        # MemoryHandler.close drops its target without closing it, which would leak the log file
+        target = self.target
+        super().close()
+        if target:
+            target.close()
 
 
 def setup_logging(log_file):
+    formatter = logging.Formatter("%(message)s")
+    # xstar output arrives a line at a time so batch it up into large writes to the log file
+    file_handler = BatchFileHandler(str(log_file))
+    file_handler.setFormatter(formatter)
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(formatter)
     logging.basicConfig(
         level=logging.INFO,
-        format="%(message)s",
-        handlers=[logging.FileHandler(log_file), logging.StreamHandler()],
+        handlers=[
+            BatchMemoryHandler(2048, flushLevel=logging.ERROR, target=file_handler),
+            stream_handler,
+        ],
     )
 
 
+def flush_logging():
+    for handler in logging.getLogger().handlers:
+        handler.flush()
+
+
 def make_xstable(args, run_dirs, model_dir):
     """Build table models from xstar runs"""
     if args:
-        base_file = Path(args[0]).with_suffix("fits")
-        base_file = Path(base_file.name)  # make sure we get the local version
+        base_file = Path(args[0]).with_suffix(".fits")
+        # make sure we get the local version
+        base_file = model_dir.parent.joinpath(base_file.name)
     else:
-        base_file = Path("xstinitable.fits")
+        base_file = model_dir.parent.joinpath("xstinitable.fits")
 
+    # these must be real copies, xstar2table updates each of them in place
     for dest_file in ["xout_ain.fits", "xout_aout.fits", "xout_mtable.fits"]:
-        copy_file(base_file, model_dir.joinpath(dest_file))
-
-    for run_dir in sorted(run_dirs):
-        run(
-            "{exe} xstarspec={spec}".format(
-                exe=get_executeable_dir().joinpath("xstar2table"),
-                spec=run_dir.joinpath("xout_spect1.fits"),
-            ),
-            os.environ,
-        )
+        copyfile(str(base_file), str(model_dir.joinpath(dest_file)))
+
+    exe = get_executeable_dir().joinpath("xstar2table")
+    cmds = [
+        [exe, "xstarspec={}".format(run_dir.joinpath("xout_spect1.fits"))]
+        for run_dir in sorted(run_dirs)
+    ]
+    # xstar2table appends a row to the same xout_*.fits files on each call
+    # so these have to run one at a time and in grid order
+    for cmd in cmds:
+        run(cmd, return_stdout=False, cwd=model_dir, stdout=None).wait()
 
 
-def process_jobs(pool, jobs, chunksize=1):
-    """Run jobs in xstar"""
-    logging.info("Using Dir " + os.getcwd())
+def process_jobs(executor, jobs, chunksize=1):
+    """Run jobs in xstar, in this process if there is no executor"""
     start_time = datetime.now()
     logging.info("Start time: {}".format(start_time))
 
-    runs_return = pool.map(run_xstar, jobs.items(), chunksize)
-
-    for ret in runs_return:
-        logging.info(ret.strip())
+    if executor is None:
+        for job in run_xstar_chunk(jobs):
+            logging.error("Job {} failed".format(job))
+    else:
+        items = list(jobs)
+        # neighbouring grid points tend to take similar times so mix them up between chunks
+        random.shuffle(items)
+        chunks = [items[i : i + chunksize] for i in range(0, len(items), chunksize)]
+        futures = {executor.submit(run_xstar_chunk, chunk): chunk for chunk in chunks}
+        for future in as_completed(futures):
+            try:
+                failed = future.result()
+            except Exception as err:
+                logging.error("Worker failed: {}".format(err))
+                failed = [job[0] for job in futures[future]]
+            for job in failed:
+                logging.error("Job {} failed".format(job))
 
     end_time = datetime.now()
     logging.info("End time: {}".format(end_time))
     logging.info("Duration {}".format(end_time - start_time))
 
 
+def run_jobs(jobs, nproc, chunksize, env):
+    """Runs the jobs on a pool of nproc workers, or inline when a pool is not worth starting"""
+    if nproc <= 1 or len(jobs) <= 1:
+        set_worker_env(env)
+        process_jobs(None, jobs)
+        return
+    ctx = get_mp_context()
+    core_slots = make_core_slots(nproc, ctx)
+    log_queue = ctx.Queue()
+    listener = None
+    try:
+        with ProcessPoolExecutor(
+            max_workers=nproc,
+            mp_context=ctx,
+            initializer=pool_init,
+            initargs=(core_slots, log_queue, env),
+        ) as executor:
+            # under fork every worker is started by the first submit, so the listener
+            # thread only starts once nothing is left to fork; records wait in the queue
+            flush_logging()
+            executor.submit(os.getpid).result()
+            listener = QueueListener(log_queue, *logging.getLogger().handlers)
+            listener.start()
+            process_jobs(executor, jobs, chunksize)
+    finally:
+        if listener:
+            listener.stop()
+
+
 def main(options, args):
-    print("Checking enviroment")
+    # set up first so nothing from the start of the run is missing from the log
+    setup_logging(options.log_file)
+    logging.info("Checking enviroment")
     check_enviroment(options.workdir)
     workdir = make_new_dir(options.workdir)
 
-    print("New dir:", workdir)
-    os.chdir(workdir)
+    logging.info("New dir: {}".format(workdir))
 
-    print("Getting jobs")
-    jobs = make_jobs(get_xstar_cmds(args, get_executeable_dir()))
+    logging.info("Getting jobs")
+    jobs = make_jobs(get_xstar_cmds(workdir, args, get_executeable_dir()))
 
     model_dir = workdir.joinpath(get_model_name(jobs))
-    print("Model dir {}".format(model_dir))
+    logging.info("Model dir {}".format(model_dir))
 
     if not model_dir.exists():
         model_dir.mkdir()
 
-    os.chdir(model_dir)
-
-    run_dirs = [model_dir.joinpath(run_dir) for run_dir in jobs.keys()]
-    make_run_dirs(run_dirs)
-
-    # setup logging
-    setup_logging(options.log_file)
-    print("Starting jobs")
-    process_jobs(mp.Pool(processes=options.nproc), jobs)
+    run_dirs = [model_dir.joinpath(run_dir) for run_dir, _ in jobs]
+    staging_dir = make_staging_dir(options.staging_dir, len(jobs)) if options.stage else None
+    if staging_dir:
+        job_dirs = [staging_dir.joinpath(run_dir) for run_dir, _ in jobs]
+    else:
+        job_dirs = run_dirs
+    setup_shared_pfiles(staging_dir or model_dir)
+
+    if options.stage:
+        logging.info("Staging dir: {}".format(staging_dir or "not enough space, running in place"))
+    logging.info("Starting jobs")
+    # snapshot once and hand to the workers, it is the base env of every xstar they start
+    worker_env = dict(os.environ, **dict.fromkeys(BLAS_THREAD_VARS, str(options.blas_threads)))
+    chunksize = options.chunksize or max(1, len(jobs) // (options.nproc * 4))
+    try:
+        run_jobs(
+            [(d, cmd) for d, (_, cmd) in zip(job_dirs, jobs)], options.nproc, chunksize, worker_env
+        )
+    finally:
+        flush_logging()
+        if staging_dir:
+            unstage_run_dirs(staging_dir, model_dir)
 
     failed = check_results(run_dirs)
     if len(failed) > 0:
@@ -305,7 +619,6 @@ def main(options, args):
         # Exit with non-zero code
         sys.exit(1)
     else:
-        os.chdir(workdir)
         make_xstable(args, run_dirs, model_dir)
 
     if not options.keeplog: